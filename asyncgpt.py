@@ -2,10 +2,28 @@ import openai
 import asyncio
 from typing import Dict, Optional, Callable, Any
 import json
+import time
 
 function_pool = {}
 regex_for_names = '^[a-zA-Z0-9_-]{1,64}$'
 
+# Цены в $ за 1M токенов: (вход, выход)
+model_prices = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+tiers = ("fast", "strong")
+
+tier_aliases = {
+    "fast": ("fast", "быстрая"),
+    "strong": ("strong", "сильная"),
+}
+
+# Слова, по которым видно, что скорее всего понадобится функция или развернутый ответ
+strong_hints = ("запомни", "забудь", "памят", "обо мне", "уточни", "код", "```")
+fast_max_chars = 80
+
 
 def register_function(
         description: str = None,
@@ -74,16 +92,101 @@ async def call_function_by_name(function_name: str, arguments: dict) -> Any:
         return {"error": "Function not found"}
 
 
+def split_tier_setting(settings: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    # Достает из настроек пользователя строку вида "модель: быстрая" или "model: strong"
+    # и возвращает выбранный уровень и настройки без этой строки, чтобы она не попала в промпт
+    if not settings:
+        return None, settings
+    tier = None
+    lines = []
+    for line in settings.splitlines():
+        key, sep, value = line.partition(":")
+        if sep and key.strip().lower() in ("model", "модель"):
+            for name, aliases in tier_aliases.items():
+                if value.strip().lower() in aliases:
+                    tier = name
+            continue
+        lines.append(line)
+    return tier, "\n".join(lines)
+
+
 class OpenAIChatBot:
-    def __init__(self, api_key: str, model: str = "gpt-4o-mini", temperature: float = 0.4):
+    def __init__(self, api_key: str, model: str = "gpt-4o-mini", temperature: float = 0.4, fast_model: Optional[str] = None):
         self.client = openai.OpenAI(api_key=api_key)
         self.model = model
+        self.fast_model = fast_model or model
         self.temperature = temperature
+        self.tier_stats = {
+            tier: {"requests": 0, "latency": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+            for tier in tiers
+        }
+        self.unpriced_models = set()
+
+    def model_for(self, tier: str) -> str:
+        return self.fast_model if tier == "fast" else self.model
 
-    async def gen_answer(self, full_context: list[Dict] | str) -> tuple:
+    @staticmethod
+    def classify(full_context: list[Dict]) -> str:
+        # Быстрая локальная оценка последнего сообщения: короткие реплики без картинок идут в быструю модель
+        content = full_context[-1].get("content") if full_context else None
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+
+        text = ""
+        for part in content or []:
+            if part.get("type") == "image_url":
+                return "strong"
+            if part.get("type") == "text":
+                text += part.get("text") or ""
+
+        if len(text) > fast_max_chars:
+            return "strong"
+        if any(hint in text.lower() for hint in strong_hints):
+            return "strong"
+        return "fast"
+
+    def record_usage(self, tier: str, model: str, completion: openai.ChatCompletion, latency: float):
+        stats = self.tier_stats[tier]
+        if model not in model_prices and model not in self.unpriced_models:
+            self.unpriced_models.add(model)
+            print(f"WARNING: No price for model '{model}' in model_prices, its cost will be reported as $0")
+        input_price, output_price = model_prices.get(model, (0.0, 0.0))
+        cost = (completion.usage.prompt_tokens * input_price + completion.usage.completion_tokens * output_price) / 1_000_000
+        stats["requests"] += 1
+        stats["latency"] += latency
+        stats["prompt_tokens"] += completion.usage.prompt_tokens
+        stats["completion_tokens"] += completion.usage.completion_tokens
+        stats["cost"] += cost
+        print(f"Completion created ({tier}, {model}): {completion.usage.prompt_tokens}t input, {completion.usage.completion_tokens}t output, {completion.usage.total_tokens}t sum, {latency:.2f}s, ${cost:.6f}")
+
+    def format_tier_stats(self) -> str:
+        lines = []
+        for tier, stats in self.tier_stats.items():
+            avg_latency = stats["latency"] / stats["requests"] if stats["requests"] else 0.0
+            lines.append(
+                f"{tier} ({self.model_for(tier)}): {stats['requests']} req, avg {avg_latency:.2f}s, "
+                f"{stats['prompt_tokens']}t input, {stats['completion_tokens']}t output, ${stats['cost']:.4f}"
+            )
+        return "\n".join(lines)
+
+    async def create_completion(self, tier: str, **kwargs) -> openai.ChatCompletion:
+        model = self.model_for(tier)
+        start = time.perf_counter()
+        completion = await asyncio.to_thread(
+            self.client.chat.completions.create,
+            model=model,
+            **kwargs
+        )
+        self.record_usage(tier, model, completion, time.perf_counter() - start)
+        return completion
+
+    async def gen_answer(self, full_context: list[Dict] | str, tier: Optional[str] = None) -> tuple:
         if isinstance(full_context, str):
             full_context = [{"role": "user", "content": full_context}]
 
+        if tier not in tiers:
+            tier = self.classify(full_context)
+
         # print("full_context:\n", json.dumps(full_context, ensure_ascii=False, indent=4))
 
         functions = [{
@@ -92,16 +195,13 @@ class OpenAIChatBot:
             "parameters": func_data["parameters"]
         } for func_name, func_data in function_pool.items()]
 
-        completion = await asyncio.to_thread(
-            self.client.chat.completions.create,
-            model=self.model,
+        completion = await self.create_completion(
+            tier,
             messages=full_context,
             functions=functions if functions else openai.NOT_GIVEN,
             function_call="auto" if functions else openai.NOT_GIVEN
         )
 
-        print(f"Completion created: {completion.usage.prompt_tokens}t input, {completion.usage.completion_tokens}t output, {completion.usage.total_tokens}t sum")
-
         function_call = self.get_function_call(completion)
         if function_call:
             arguments = self.get_args_from_response(completion)
@@ -109,9 +209,8 @@ class OpenAIChatBot:
 
             if not needs_followup: return function_result
 
-            follow_up: openai.ChatCompletion = await asyncio.to_thread(
-                self.client.chat.completions.create,
-                model=self.model,
+            follow_up: openai.ChatCompletion = await self.create_completion(
+                tier,
                 messages=full_context + [
                     {"role": "assistant", "content": None, "function_call": completion.function_call},
                     {"role": "function", "name": function_call, "content": json.dumps(function_result)}
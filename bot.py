@@ -7,11 +7,14 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.fsm.storage.memory import MemoryStorage
 import logger
 import json
+import time
 import asyncgpt
 import db
+import quota
 
 
 # region Utils
@@ -46,10 +49,13 @@ print("Setting OpenAI token")
 gpt = asyncgpt.OpenAIChatBot(
     creds["openai_token"],
     temperature=0.4,
-    model="gpt-4o-mini",
+    model=creds.get("openai_model", "gpt-4o-mini"),
+    fast_model=creds.get("openai_fast_model", "gpt-4o-mini"),
 )
 print("OpenAI connected")
 
+quotas = quota.QuotaManager()
+
 
 # endregion
 
@@ -72,6 +78,8 @@ async def on_startup(dispatcher: Dispatcher):
 
 @dp.shutdown()
 async def on_shutdown(*args, **kwargs):
+    await quotas.save()
+    print(f"Model usage:\n{gpt.format_tier_stats()}")
     print(f"Bot \'{(await bot.get_me()).username}\' stopped")
 
 
@@ -81,7 +89,35 @@ class LogCommandsMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+class AdmissionControlMiddleware(BaseMiddleware):
+    def __init__(self, quota_manager: quota.QuotaManager):
+        self.quotas = quota_manager
+        self.notified_until: dict[int, float] = {}
+
+    async def __call__(self, handler, event: Message, data: dict):
+        # Квота тратится только на хендлеры с флагом quota и только на сообщения, которые дойдут до модели
+        if not get_flag(data, "quota") or not event.text and not event.photo or event.from_user.id == bot.id:
+            return await handler(event, data)
+
+        # Промпт к OpenAI - это весь контекст пользователя плюс новое сообщение
+        tokens = await db.get_context_len(event.from_user.id)
+        tokens += db.history_len([{"text": event.text or event.caption, "image_url": bool(event.photo)}])
+        user_id = event.from_user.id
+        wait = self.quotas.try_acquire(user_id, tokens)
+        await self.quotas.save_if_due()
+        if wait > 0:
+            # Предупреждаем один раз за окно ожидания, остальные сообщения молча отбрасываем
+            now = time.time()
+            if self.notified_until.get(user_id, 0) <= now:
+                self.notified_until[user_id] = now + wait
+                await event.answer(f"Слишком много запросов, попробуйте еще раз через {int(wait) + 1} сек.")
+            return
+        self.notified_until.pop(user_id, None)
+        return await handler(event, data)
+
+
 dp.message.middleware.register(LogCommandsMiddleware())
+dp.message.middleware.register(AdmissionControlMiddleware(quotas))
 
 
 # endregion
@@ -90,7 +126,7 @@ dp.message.middleware.register(LogCommandsMiddleware())
 # region Commands
 
 
-@dp.message(Command("start"))
+@dp.message(Command("start"), flags={"quota": True})
 async def start(message: Message):
     resp = await gpt.gen_answer(
         "Привет"
@@ -112,7 +148,7 @@ class SettingsState(StatesGroup):
 
 @dp.message(Command("set_settings"))
 async def set_settings(message: Message, state: FSMContext):
-    await message.answer("Напишите новые настройки (пример: Отвечай только на английском)")
+    await message.answer("Напишите новые настройки (пример: Отвечай только на английском; чтобы выбрать модель, добавьте строку «модель: быстрая» или «модель: сильная»)")
     await state.set_state(SettingsState.waiting_for_settings)
 
 
@@ -125,7 +161,7 @@ async def get_settings(message: Message):
 @dp.message(SettingsState.waiting_for_settings)
 async def set_settings(message: Message, state: FSMContext):
     if not message.text:
-        await message.answer("Напишите новые настройки (пример: Отвечай только на английском)")
+        await message.answer("Напишите новые настройки (пример: Отвечай только на английском; чтобы выбрать модель, добавьте строку «модель: быстрая» или «модель: сильная»)")
         return
     await db.set_settings(message.from_user.id, message.text)
     await message.answer("Настройки сохранены")
@@ -137,13 +173,20 @@ async def drop_settings(message: Message):
     await db.drop_settings(message.from_user.id)
     await message.answer("Настройки очищены")
 
+
+@dp.message(Command("stats"))
+async def stats(message: Message):
+    if message.from_user.id not in creds.get("admin_ids", []):
+        return
+    await message.answer(f"Статистика моделей:\n```text\n{gpt.format_tier_stats()}\n```", parse_mode="MarkdownV2")
+
 # endregion
 
 
 # region Main Functionality
 
 
-@dp.message()
+@dp.message(flags={"quota": True})
 async def handle_message(message: Message):
     user_id = message.from_user.id
 
@@ -161,12 +204,12 @@ async def handle_message(message: Message):
         if message.caption:
             user_text = message.caption
 
-    context = await db.get_full_context(user_id)
+    context, tier = await db.get_full_context(user_id)
     # print("Text: ", user_text, "File: ", file_url)
     context += [gpt.pack_message(user_text, [file_url], "user")]
 
     try:
-        response = await gpt.gen_answer(context)
+        response = await gpt.gen_answer(context, tier=tier)
     except Exception as e:
         logger.err(e)
         response = "Произошла неизвестная ошибка, попробуйте еще раз позже."
@@ -2,7 +2,7 @@ import json
 import os
 from typing import List, Optional
 import asyncio
-from asyncgpt import OpenAIChatBot
+from asyncgpt import OpenAIChatBot, split_tier_setting
 import aiofiles
 
 history_path = "db"
@@ -27,6 +27,17 @@ def history_len(history: list[dict]) -> int:
     return total_tokens
 
 
+# Кэш оценки полного промпта пользователя (настройки + память + история), чтобы не читать файл на каждое сообщение
+context_tokens: dict[int, int] = {}
+
+
+def context_len(history_data: dict) -> int:
+    return history_len(history_data["messages"] + [
+        {"text": default_settings + (history_data["settings"] or "")},
+        {"text": history_data["memory"]},
+    ])
+
+
 class Message:
     def __init__(self, role: str, text: Optional[str] = None, image_url: Optional[str] = None):
         self.role = role
@@ -68,12 +79,30 @@ async def add_to_history(user_id: int, role: str, text: Optional[str] = None, im
 
     history["messages"].append(Message(role, text, image_url).to_dict())
 
-    while history_len(history["messages"]) > max_history_len and len(history) > 3:
-        history.pop(0)
+    while history_len(history["messages"]) > max_history_len and len(history["messages"]) > 1:
+        history["messages"].pop(0)
 
     async with aiofiles.open(file_path, mode='w', encoding='utf-8') as f:
         await f.write(json.dumps(history, ensure_ascii=False, indent=4))
 
+    context_tokens[user_id] = context_len(history)
+
+
+async def get_context_len(user_id: int) -> int:
+    if user_id in context_tokens:
+        return context_tokens[user_id]
+
+    file_path = get_path(user_id)
+
+    if not os.path.exists(file_path):
+        return history_len([{"text": default_settings}])
+
+    async with aiofiles.open(file_path, mode='r', encoding='utf-8') as f:
+        history_data = json.loads(await f.read())
+
+    context_tokens[user_id] = context_len(history_data)
+    return context_tokens[user_id]
+
 
 async def set_memory(user_id: int, memory: str | None):
     file_path = get_path(user_id)
@@ -83,6 +112,7 @@ async def set_memory(user_id: int, memory: str | None):
         history_data["memory"] = memory
         async with aiofiles.open(file_path, mode='w', encoding='utf-8') as f:
             await f.write(json.dumps(history_data, ensure_ascii=False, indent=4))
+    context_tokens.pop(user_id, None)
 
 
 async def get_memory(user_id: int) -> str:
@@ -121,8 +151,9 @@ async def get_history(user_id: int) -> List[Message]:
     return [Message.from_dict(item) for item in history_data["messages"]]
 
 
-async def get_full_context(user_id: int) -> List[dict]:
-    settings_str = await get_settings(user_id)
+async def get_full_context(user_id: int) -> tuple[List[dict], Optional[str]]:
+    # Возвращает контекст и уровень модели, выбранный пользователем в настройках (или None)
+    tier, settings_str = split_tier_setting(await get_settings(user_id))
     memory_str = await get_memory(user_id)
     history = await get_history(user_id)
     context = []
@@ -135,7 +166,7 @@ async def get_full_context(user_id: int) -> List[dict]:
     for message in history:
         context.append(OpenAIChatBot.pack_message(message.text, [message.image_url], message.role))
     # print(f"Got {history_len([msg.to_dict() for msg in history])} tokens from history")
-    return context
+    return context, tier
 
 
 async def set_settings(user_id: int, settings: str):
@@ -146,6 +177,7 @@ async def set_settings(user_id: int, settings: str):
         history_data["settings"] = settings
         async with aiofiles.open(file_path, mode='w', encoding='utf-8') as f:
             await f.write(json.dumps(history_data, ensure_ascii=False, indent=4))
+    context_tokens.pop(user_id, None)
 
 
 async def drop_settings(user_id: int):
@@ -156,6 +188,7 @@ async def drop_settings(user_id: int):
         history_data["settings"] = None
         async with aiofiles.open(file_path, mode='w', encoding='utf-8') as f:
             await f.write(json.dumps(history_data, ensure_ascii=False, indent=4))
+    context_tokens.pop(user_id, None)
 
 
 async def drop_history(user_id: int):
@@ -166,3 +199,4 @@ async def drop_history(user_id: int):
         history_data["messages"] = []
         async with aiofiles.open(file_path, mode='w', encoding='utf-8') as f:
             await f.write(json.dumps(history_data, ensure_ascii=False, indent=4))
+    context_tokens.pop(user_id, None)
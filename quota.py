@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+import aiofiles
+import db
+
+quotas_path = os.path.join(db.history_path, "quotas.json")
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_rate: float, tokens: Optional[float] = None, updated: Optional[float] = None):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # единиц в секунду
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # Запрос больше емкости ведра никогда бы не прошел, поэтому ограничиваем его емкостью
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_rate
+
+    def consume(self, amount: float):
+        self.tokens = max(0.0, self.tokens - min(amount, self.capacity))
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    def to_dict(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "updated": self.updated,
+        }
+
+    @classmethod
+    def from_dict(cls, capacity: float, refill_rate: float, data: dict):
+        return cls(
+            capacity,
+            refill_rate,
+            tokens=data.get("tokens"),
+            updated=data.get("updated")
+        )
+
+
+# Ведра на пользователя и глобальные: в запросах и в оценке токенов промпта.
+# Лимиты задаются в минуту, состояние хранится в памяти и сбрасывается на диск раз в persist_interval секунд.
+class QuotaManager:
+    def __init__(
+            self,
+            user_requests: int = 10,
+            user_tokens: int = 20000,
+            global_requests: int = 200,
+            global_tokens: int = 200000,
+            persist_interval: float = 60,
+            path: str = quotas_path
+    ):
+        self.limits = {
+            "requests": (user_requests, user_requests / 60),
+            "tokens": (user_tokens, user_tokens / 60),
+        }
+        self.global_limits = {
+            "requests": (global_requests, global_requests / 60),
+            "tokens": (global_tokens, global_tokens / 60),
+        }
+        self.persist_interval = persist_interval
+        self.path = path
+        self.users: dict[int, dict[str, TokenBucket]] = {}
+        self.global_buckets = self.new_buckets(self.global_limits)
+        self.last_saved = time.time()
+        self.save_lock = asyncio.Lock()
+        self.load()
+
+    @staticmethod
+    def new_buckets(limits: dict, data: Optional[dict] = None) -> dict[str, TokenBucket]:
+        data = data or {}
+        return {
+            kind: TokenBucket.from_dict(capacity, rate, data.get(kind, {}))
+            for kind, (capacity, rate) in limits.items()
+        }
+
+    def user_buckets(self, user_id: int) -> dict[str, TokenBucket]:
+        if user_id not in self.users:
+            self.users[user_id] = self.new_buckets(self.limits)
+        return self.users[user_id]
+
+    def try_acquire(self, user_id: int, tokens: int) -> float:
+        # Возвращает 0, если запрос пропущен, иначе сколько секунд нужно подождать
+        now = time.time()
+        amounts = {"requests": 1, "tokens": tokens}
+        buckets = [self.user_buckets(user_id), self.global_buckets]
+
+        wait = 0.0
+        for group in buckets:
+            for kind, bucket in group.items():
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amounts[kind]))
+        if wait > 0:
+            return wait
+
+        for group in buckets:
+            for kind, bucket in group.items():
+                bucket.consume(amounts[kind])
+        return 0.0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Could not load quotas: {e}")
+            return
+        self.global_buckets = self.new_buckets(self.global_limits, data.get("global"))
+        self.users = {
+            int(user_id): self.new_buckets(self.limits, buckets)
+            for user_id, buckets in data.get("users", {}).items()
+        }
+
+    async def save(self):
+        async with self.save_lock:
+            now = time.time()
+            # Отмечаем сразу, чтобы апдейты во время записи не запускали еще одно сохранение
+            self.last_saved = now
+            for group in self.users.values():
+                for bucket in group.values():
+                    bucket.refill(now)
+            # Полное ведро ничем не отличается от нового, его можно не хранить
+            self.users = {
+                user_id: group for user_id, group in self.users.items()
+                if not all(bucket.is_full() for bucket in group.values())
+            }
+            data = {
+                "global": {kind: bucket.to_dict() for kind, bucket in self.global_buckets.items()},
+                "users": {
+                    str(user_id): {kind: bucket.to_dict() for kind, bucket in group.items()}
+                    for user_id, group in self.users.items()
+                },
+            }
+            # Пишем во временный файл и подменяем, чтобы падение посреди записи не оставило обрезанный файл
+            tmp_path = self.path + ".tmp"
+            async with aiofiles.open(tmp_path, mode='w', encoding='utf-8') as f:
+                await f.write(json.dumps(data, ensure_ascii=False, indent=4))
+            os.replace(tmp_path, self.path)
+
+    async def save_if_due(self):
+        if time.time() - self.last_saved >= self.persist_interval and not self.save_lock.locked():
+            await self.save()